@@ -0,0 +1,2618 @@
+import click
+import codecs
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from uplink import Consumer, RequestsClient, Body, Path, Query, post, returns, headers
+from types import SimpleNamespace
+import re
+import os
+import csv
+import json
+import sqlite3
+import hashlib
+import tempfile
+import math
+import time
+import functools
+import itertools
+import threading
+import email.utils
+import datetime
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from mbpy_endpoints.endpoints import Endpoint
+from json import JSONDecoder
+from json.decoder import JSONDecodeError
+import numpy as np
+import pandas as pd
+import requests_cache
+
+try:
+    import orjson
+except ImportError:  # optional, faster full-body decoder
+    orjson = None
+try:
+    import ijson
+except ImportError:  # optional, C-backed streaming parser
+    ijson = None
+try:
+    import fcntl
+except ImportError:  # not on Windows, where the token store is not locked
+    fcntl = None
+try:
+    import pyarrow.parquet
+except ImportError:  # optional, for parquet extracts and replaying them
+    pyarrow = None
+
+
+BASEURL = ""  # PowerSchool Base url
+OAUTH_BASEURL = ""  # PowerSchool oauth token baseurl
+ENROLLMENT_PAGESIZE = 10000
+ENTITY_PAGESIZE = 2000
+MIN_ENTITY_PAGESIZE = 250
+MAX_ENTITY_PAGESIZE = 16000
+TARGET_PAGE_SECONDS = 10
+
+STUDENT_KEY = "tables.students.student_number"
+# the column each PowerSchool entity is keyed by
+ENTITY_KEYS = {
+    "students": STUDENT_KEY,
+    "teachers": "tables.teachers.id",
+    "parents": STUDENT_KEY,
+}
+
+HTTP_CACHE = "~/outputs/http_cache"
+# Read-only endpoints worth caching between runs, and for how long. Anything
+# else, including every ManageBac write, is never cached.
+# Year groups are left out: the sync adds students to them, and the next run
+# must see those adds.
+HTTP_CACHE_TTLS = {
+    "*/ws/schema/query/*": datetime.timedelta(minutes=30),  # PowerQueries
+    "*/v2/school/academic-years*": datetime.timedelta(days=1),
+    "*/v2/classes*": datetime.timedelta(hours=1),
+}
+
+
+def is_cacheable(response):
+    """
+    PowerQueries are POSTs but only read; otherwise, only GETs are cached
+    """
+    request = response.request
+    return request.method == "GET" or "/ws/schema/query/" in request.url
+
+
+def configure_cache(mode, consumers=()):
+    """
+    Install the persistent HTTP cache for sessions created from now on, and
+    for the already built uplink `consumers`. Expired responses that carry an
+    ETag or Last-Modified are revalidated with a conditional request instead
+    of being downloaded again
+    """
+    if mode == "off":
+        return
+    requests_cache.install_cache(
+        os.path.expanduser(HTTP_CACHE),
+        backend="sqlite",
+        expire_after=requests_cache.DO_NOT_CACHE,
+        urls_expire_after=HTTP_CACHE_TTLS,
+        allowable_methods=("GET", "POST"),
+        filter_fn=is_cacheable,
+    )
+    if mode == "clear":
+        requests_cache.clear()
+    for consumer in consumers:
+        cache_consumer(consumer)
+
+
+def cache_consumer(consumer):
+    """
+    Swap the session of an uplink consumer built before install_cache, like
+    mbpy's Endpoint, for a cached one with the same settings
+    """
+    session = consumer_session(consumer)
+    if isinstance(session, requests_cache.CacheMixin):
+        return session
+    cached = requests.Session()  # a CachedSession while the cache is installed
+    for name in requests.Session.__attrs__:
+        setattr(cached, name, getattr(session, name))
+    consumer._Consumer__client._RequestsClient__session = cached
+    return cached
+
+
+class Record:
+    """
+    Base for the compact record types that dot() generates, one per set of keys
+    """
+
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for key, value in zip(self.__slots__, values):
+            setattr(self, key, value)
+
+    def __repr__(self):
+        items = ", ".join(
+            f"{key}={getattr(self, key)!r}"
+            for key in self.__slots__
+            if hasattr(self, key)
+        )
+        return f"{type(self).__name__}({items})"
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(
+            getattr(self, key, None) == getattr(other, key, None)
+            for key in self.__slots__
+        )
+
+
+_record_types = {}
+
+
+def record_type(keys: tuple):
+    """
+    Return the Record subclass with a slot for each of `keys`, creating it once
+    """
+    cls = _record_types.get(keys)
+    if cls is None:
+        cls = type("Record", (Record,), {"__slots__": keys})
+        _record_types[keys] = cls
+    return cls
+
+
+def dot(data):
+    if type(data) is list:
+        return list(map(dot, data))
+    elif type(data) is dict:
+        keys = tuple(data)
+        if not all(key.isidentifier() for key in keys):
+            sns = SimpleNamespace()
+            for key, value in data.items():
+                setattr(sns, key, dot(value))
+            return sns
+        return record_type(keys)(*map(dot, data.values()))
+    else:
+        return data
+
+
+def iter_json_stream(response, chunk_size=64 * 1024):
+    """
+    Yield the items of the top-level `record` array from the response body,
+    decoding one item at a time as the body is read
+    """
+    decoder = JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    chunks = response.iter_content(chunk_size=chunk_size)
+    buffer, pos = "", 0
+
+    def fill():
+        nonlocal buffer, pos
+        chunk = next(chunks, None)
+        if chunk is None:
+            return False
+        buffer = buffer[pos:] + text.decode(chunk)
+        pos = 0
+        return True
+
+    def peek():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            if not fill():
+                raise JSONDecodeError("Unexpected end of response", buffer, pos)
+
+    def expect(*chars):
+        nonlocal pos
+        char = peek()
+        if char not in chars:
+            raise JSONDecodeError(f"Expecting one of {chars}", buffer, pos)
+        pos += 1
+        return char
+
+    def value():
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                result, end = decoder.raw_decode(buffer, pos)
+            except JSONDecodeError:
+                if fill():
+                    continue
+                raise
+            # a number may continue into the next chunk, even when what came
+            # so far decodes on its own, like the "3." of "3.75" or "1e" of "1e5"
+            cut = end == len(buffer) or (
+                isinstance(result, (int, float)) and buffer[end] in ".eE+-"
+            )
+            if cut and fill():
+                continue
+            pos = end
+            return result
+
+    expect("{")
+    if peek() == "}":
+        return
+    while True:
+        key = value()
+        expect(":")
+        if key == "record" and peek() == "[":
+            expect("[")
+            if peek() == "]":
+                pos += 1
+            else:
+                while True:
+                    yield value()
+                    if expect(",", "]") == "]":
+                        break
+        elif key == "record":
+            yield from value() or []
+        else:
+            value()
+        if expect(",", "}") == "}":
+            return
+
+
+def iter_records(response):
+    """
+    Yield the PowerQuery records in the response, using the DECODER backend
+    """
+    if DECODER == "ijson":
+        response.raw.decode_content = True
+        yield from ijson.items(response.raw, "record.item", use_float=True)
+    elif DECODER == "orjson":
+        yield from orjson.loads(response.content).get("record", [])
+    elif DECODER == "stream":
+        yield from iter_json_stream(response)
+    else:
+        yield from response.json().get("record", [])
+
+
+DECODER = "ijson" if ijson is not None else "stream"
+
+
+class EntityTable:
+    """
+    A flattened PowerQuery entity, one column per dotted path, e.g.
+    `tables.students.grade`
+    """
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.columns = {name: frame[name].array for name in frame.columns}
+        self.prefixes = set()
+        for name in frame.columns:
+            parts = name.split(".")
+            for i in range(1, len(parts)):
+                self.prefixes.add(".".join(parts[:i]) + ".")
+
+    def row(self, position):
+        return TableRow(self, position)
+
+
+class TableRow:
+    """
+    Attribute view onto one row of an EntityTable, so that
+    `row.tables.students.grade` reads the `tables.students.grade` column.
+    Keys absent from the source record raise AttributeError, as with dot()
+    """
+
+    __slots__ = ("_table", "_position", "_prefix")
+
+    def __init__(self, table, position, prefix=""):
+        self._table = table
+        self._position = position
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        path = self._prefix + name
+        column = self._table.columns.get(path)
+        if column is not None:
+            value = column[self._position]
+            if isinstance(value, float) and value != value:
+                # NaN marks a key that was missing from this record
+                raise AttributeError(name)
+            if isinstance(value, np.generic):
+                value = value.item()
+            return value
+        if path + "." in self._table.prefixes:
+            return TableRow(self._table, self._position, path + ".")
+        raise AttributeError(name)
+
+    def __repr__(self):
+        return f"TableRow({self._prefix or '.'}@{self._position})"
+
+
+def get_dotted_path(data: dict, path: str, default=None):
+    pathList = re.split(r"\.", path, flags=re.IGNORECASE)
+    result = data
+    for key in pathList:
+        try:
+            result = result[key]
+        except:
+            result = default
+            break
+
+    return result
+
+
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+import smtplib
+
+import io, ssl
+
+
+def export_csv(df):
+    with io.StringIO() as buffer:
+        df.to_csv(buffer, index=False)
+        return buffer.getvalue()
+
+
+def send_email(from_, send_to, subject, body, password, *dataframes):
+    """
+    Email the body with each (filename, df) attached as csv; a path is attached as is
+    """
+    multipart = MIMEMultipart()
+
+    multipart["From"] = from_
+    multipart["To"] = ",".join(send_to)
+    multipart["Subject"] = subject
+
+    for filename, df in dataframes:
+        if isinstance(df, str):
+            with open(df, "rb") as f:
+                content = f.read()
+        else:
+            content = export_csv(df)
+        attachment = MIMEApplication(content, Name=filename)
+        attachment["Content-Disposition"] = f'attachment; filename="{filename}"'
+        multipart.attach(attachment)
+
+    multipart.add_header("Content-Type", "text/plain")
+    multipart.attach(MIMEText(body, "plain"))
+
+    context = ssl.create_default_context()
+    data = multipart.as_bytes()
+    with smtplib.SMTP_SSL("smtp.gmail.com", 465, context=context) as email:
+        email.login(from_, password)
+        email.sendmail(from_, send_to, data)
+
+
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 300  # large PowerQuery pages can take minutes to start streaming
+
+
+class TimeoutAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that applies a default (connect, read) timeout
+    """
+
+    def __init__(self, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=timeout or self.timeout, **kwargs)
+
+
+def pooled_session(pool_size=10, session=None):
+    """
+    A keep-alive session that holds up to `pool_size` connections per host,
+    asks for compressed bodies and times out stalled requests. When the pool
+    is exhausted, requests wait for a free connection rather than opening one
+    that would be thrown away
+    """
+    session = session or requests.Session()
+    adapter = TimeoutAdapter(pool_maxsize=pool_size, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # urllib3 lists br (and zstd) only when it can decode them
+    session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+    session.headers["Connection"] = "keep-alive"
+    return session
+
+
+def consumer_session(consumer):
+    """
+    The requests session an uplink consumer sends through. `consumer.session`
+    is uplink's own request settings, and uplink keeps the client private, so
+    this is the only way at the session of an Endpoint mbpy built
+    """
+    return consumer._Consumer__client._RequestsClient__session
+
+
+def transport_stats(session):
+    """
+    Map each host to (requests sent, connections opened) for `session`
+    """
+    stats = {}
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            if pool is not None:
+                stats[pool.host] = (pool.num_requests, pool.num_connections)
+    return stats
+
+
+@headers({"Content-Type": "application/x-www-form-urlencoded"})
+class GetToken(Consumer):
+    def __init__(self, client_id, client_secret, ps_oauth_baseurl, client=None):
+        if client is None:
+            client = RequestsClient(session=pooled_session(pool_size=1))
+        base_url = ps_oauth_baseurl
+        super(GetToken, self).__init__(base_url=base_url, client=client)
+        bearer_token = base64.b64encode(
+            bytes(client_id + ":" + client_secret, "ISO-8859-1")
+        ).decode("ascii")
+        self.session.headers["Authorization"] = f"Basic {bearer_token}"
+
+    @post("oauth/access_token")
+    @returns.json(key="access_token")
+    def get_access_token(self, grant_type: Query = "client_credentials"):
+        pass
+
+
+import base64
+
+TOKEN_STORE = "~/.cache/mbpy_plugin_powerschool/tokens.json"
+TOKEN_REFRESH_MARGIN = 300  # seconds before expiry to fetch a new token
+
+
+class TokenManager(requests.auth.AuthBase):
+    """
+    Bearer token for PsWeb requests, kept with its expiry in a private local
+    store so runs and worker processes reuse it. A new token is fetched
+    shortly before it expires, or when PowerSchool answers 401; requests in
+    flight meanwhile keep the token they were sent with.
+    """
+
+    def __init__(self, client_id, client_secret, ps_oauth_baseurl, path=TOKEN_STORE):
+        self.oauth = GetToken(
+            client_id, client_secret, ps_oauth_baseurl=ps_oauth_baseurl
+        )
+        self.path = os.path.expanduser(path)
+        self.key = hashlib.sha1(f"{ps_oauth_baseurl}|{client_id}".encode()).hexdigest()
+        self.lock = threading.Lock()
+        self.token = None
+        self.expires = 0.0
+
+    def __call__(self, request):
+        request.headers["Authorization"] = f"Bearer {self.access_token()}"
+        request.register_hook("response", self.retry_unauthorized)
+        return request
+
+    def is_fresh(self, expires):
+        return time.time() < expires - TOKEN_REFRESH_MARGIN
+
+    def access_token(self):
+        if self.token is None or not self.is_fresh(self.expires):
+            with self.lock:
+                if self.token is None or not self.is_fresh(self.expires):
+                    self.refresh(stale=self.token)
+        return self.token
+
+    def refresh(self, stale=None):
+        """
+        Take the stored token if another run already replaced `stale`,
+        otherwise fetch a new one and store it
+        """
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        with open(f"{self.path}.lock", "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            tokens = self.read()
+            stored = tokens.get(self.key, {})
+            token, expires = stored.get("access_token"), stored.get("expires", 0.0)
+            if token is None or token == stale or not self.is_fresh(expires):
+                response = self.oauth.get_access_token().json()
+                token = response.get("access_token")
+                if token is None:
+                    raise Exception("No access token returned!")
+                expires = time.time() + float(response.get("expires_in", 3600))
+                tokens[self.key] = {"access_token": token, "expires": expires}
+                self.write(tokens)
+        self.token, self.expires = token, expires
+
+    def read(self):
+        try:
+            with open(self.path) as store:
+                return json.load(store)
+        except (OSError, ValueError):
+            return {}
+
+    def write(self, tokens):
+        handle, temporary = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        with os.fdopen(handle, "w") as store:  # mkstemp creates it as 0600
+            json.dump(tokens, store)
+        os.replace(temporary, self.path)
+
+    def retry_unauthorized(self, response, **kwargs):
+        if response.status_code != 401 or getattr(response.request, "retried", False):
+            return response
+        sent = response.request.headers["Authorization"].split(" ", 1)[-1]
+        with self.lock:
+            if sent == self.token:
+                # nobody has refreshed it since this request went out
+                self.refresh(stale=sent)
+        response.content
+        response.close()
+        request = response.request.copy()
+        request.headers["Authorization"] = f"Bearer {self.token}"
+        request.retried = True
+        retried = response.connection.send(request, **kwargs)
+        retried.history.append(response)
+        retried.request = request
+        return retried
+
+
+@headers({"Content-Type": "application/json"})
+class PsWeb(Consumer):
+    def __init__(
+        self,
+        client_id,
+        client_secret,
+        ps_oauth_baseurl,
+        base_url,
+        client=None,
+        pool_size=10,
+    ):
+        session = None
+        if client is None:
+            # stream bodies so records can be decoded while they download
+            session = pooled_session(pool_size=pool_size)
+            session.stream = True
+            client = RequestsClient(session=session)
+        self.transport = session
+        self.tokens = TokenManager(
+            client_id, client_secret, ps_oauth_baseurl=ps_oauth_baseurl
+        )
+        access_token = self.tokens.access_token()
+
+        super(PsWeb, self).__init__(base_url=base_url, client=client)
+        if session is not None:
+            session.auth = self.tokens
+        else:
+            self.session.headers["Authorization"] = f"Bearer {access_token}"
+
+    @post("mk.ManageBac_Stu")
+    def get_students(
+        self, pagesize: Query = ENTITY_PAGESIZE, page: Query = 1, **body: Body
+    ):
+        pass
+
+    @post("mk.ManageBac_Par")
+    def get_parents(
+        self, pagesize: Query = ENTITY_PAGESIZE, page: Query = 1, **body: Body
+    ):
+        pass
+
+    @post("mk.ManageBac_Tea")
+    def get_teachers(
+        self, pagesize: Query = ENTITY_PAGESIZE, page: Query = 1, **body: Body
+    ):
+        pass
+
+    @post("mk.ManageBac_Stu_Class")
+    def get_enrollments(
+        self, pagesize: Query = ENROLLMENT_PAGESIZE, page: Query = 1, **body: Body
+    ):
+        pass
+
+    @post("mk.ManageBac_Stu/count")
+    def count_students(self, **body: Body):
+        pass
+
+    @post("mk.ManageBac_Par/count")
+    def count_parents(self, **body: Body):
+        pass
+
+    @post("mk.ManageBac_Tea/count")
+    def count_teachers(self, **body: Body):
+        pass
+
+    @post("mk.ManageBac_Stu_Class/count")
+    def count_enrollments(self, **body: Body):
+        pass
+
+
+def count_records(api, entity, **body):
+    """
+    Number of `entity` records the PowerQuery's count endpoint reports
+    """
+    response = getattr(api, f"count_{entity}")(**body)
+    if not response.ok:
+        raise Exception(
+            f"{response.request.url} => {response.status_code}\n{response.text}"
+        )
+    return response.json().get("count", 0)
+
+
+def read_page(response, entity):
+    """
+    Decode one page of `entity` records, raising if PowerSchool did not
+    answer with one
+    """
+    with response:
+        if not response.ok:
+            raise Exception(
+                f"{response.request.url} => {response.status_code}\n{response.text}"
+            )
+        try:
+            return list(iter_records(response))
+        except (JSONDecodeError, ValueError) as err:
+            raise Exception(
+                f"{response.request.url} => could not decode {entity} page: {err}"
+            ) from err
+
+
+def iter_entity_pages(api, entity, pagesize=ENTITY_PAGESIZE, **body):
+    """
+    Page through the PowerQuery for `entity`, yielding each page of records,
+    until the number of records its count endpoint reported have come back
+
+    The page size halves when a page is slower than TARGET_PAGE_SECONDS and
+    doubles when it is much faster. It only changes at offsets that are a
+    multiple of the new size, so no record is skipped or repeated. A page
+    with other than the expected number of records means the server caps the
+    page size below ours; it is fetched again at half the size, which then
+    stays the ceiling.
+    """
+    total = count_records(api, entity, **body)
+    method = getattr(api, f"get_{entity}")
+    ceiling = MAX_ENTITY_PAGESIZE
+    offset = 0
+    while offset < total:
+        started = time.monotonic()
+        response = method(pagesize=pagesize, page=offset // pagesize + 1, **body)
+        elapsed = time.monotonic() - started
+        records = read_page(response, entity)
+        if not records:
+            break  # records were removed while paging
+        expected = min(pagesize, total - offset)
+        if len(records) != expected and pagesize > MIN_ENTITY_PAGESIZE:
+            # a short page, or a last page from the wrong offset, means the
+            # server caps the page size below ours
+            pagesize //= 2
+            ceiling = pagesize
+            continue
+        if len(records) < expected:
+            raise Exception(
+                f"{entity} page at {offset} had {len(records)} records, "
+                f"{expected} expected"
+            )
+        yield records
+        offset += len(records)
+
+        if elapsed > TARGET_PAGE_SECONDS and pagesize > MIN_ENTITY_PAGESIZE:
+            pagesize //= 2
+        elif (
+            elapsed < TARGET_PAGE_SECONDS / 4
+            and pagesize * 2 <= ceiling
+            and offset % (pagesize * 2) == 0
+        ):
+            pagesize *= 2
+
+
+def load_entity(api, entity, path, **body):
+    """
+    Load every `entity` record matching the PowerQuery arguments in `body`,
+    keyed by the column at `path`
+    """
+    frames = [
+        pd.json_normalize(records)
+        for records in iter_entity_pages(api, entity, **body)
+    ]
+    if not frames and body:
+        # a filtered pull may legitimately have nothing in it
+        return (pd.DataFrame(columns=[path]), {})
+    if not frames:
+        message = f"No {entity} records found? Must be an issue with the powerschool source. Exiting with no actions taken"
+        raise Exception(message)
+
+    df = pd.concat(frames, ignore_index=True, sort=False)
+    del frames
+    write_extract(df, entity, f"~/outputs/output_{entity}.csv")
+    return index_entity(df, entity, path)
+
+
+def index_entity(df, entity, path):
+    """
+    Key the rows of a loaded `entity` frame by the column at `path`
+    """
+    keys = df[path]
+    keep = np.ones(len(df), dtype=bool)
+    if entity == "teachers":
+        keep = (keys.notna() & keys.astype(bool)).to_numpy()
+        df.loc[keep, path] = keys[keep].str.lower()
+        keys = df[path]
+
+    table = EntityTable(df)
+    objects = {
+        value: table.row(position)
+        for position, value in enumerate(keys.array)
+        if keep[position]
+    }
+    return (df, objects)
+
+
+def iter_enrollment_pages(api, **body):
+    """
+    Fetch enrollment pages one at a time, until an empty page comes back
+    """
+    page = 1
+    while True:
+        records = read_page(api.get_enrollments(page=page, **body), "enrollments")
+        if not records:
+            break
+        yield records
+        page += 1
+
+
+def fetch_enrollment_pages(api, workers, total, pagesize=ENROLLMENT_PAGESIZE, **body):
+    """
+    Fetch the pages holding `total` enrollments concurrently, yielding them in
+    page order
+    """
+    pages = math.ceil(total / pagesize)
+
+    def fetch(page):
+        response = api.get_enrollments(pagesize=pagesize, page=page, **body)
+        return read_page(response, "enrollments")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # map returns results in submission order, whatever order they finish in
+        yield from pool.map(fetch, range(1, pages + 1))
+
+
+def load_enrollments(api, workers=1, **body):
+    """
+    Load all enrollments matching the PowerQuery arguments in `body`, fetching
+    pages with up to `workers` concurrent requests. Raises if fewer come back
+    than PowerSchool counted, so that a partial schedule is never diffed
+    """
+    total = count_records(api, "enrollments", **body)
+    if workers > 1:
+        pages = fetch_enrollment_pages(api, workers, total, **body)
+    else:
+        pages = iter_enrollment_pages(api, **body)
+    records, objects, classes = index_enrollments(pages)
+    if len(records) < total:
+        raise Exception(f"Only {len(records)} of {total} enrollments came back")
+
+    df = pd.DataFrame.from_records(records)
+    write_extract(df, "enrollments", "/tmp/output_schedule.csv", records=records)
+    return (df, objects, classes)
+
+
+def index_enrollments(pages):
+    """
+    Key the enrollment records in `pages` by student number and class id,
+    returning the records, the keyed enrollments and the set of class ids
+    """
+    objects = defaultdict(lambda: defaultdict(dict))
+    classes = []
+    records = []
+    mapped_classes = []
+    for these_records in pages:
+        records.extend(these_records)
+        for item in these_records:
+            dotted = dot(item)
+            section_number = dotted.tables.sections.section_number
+            class_id = dotted.tables.sections.class_id
+            if not section_number.isdigit():
+                class_id = f"{class_id}{section_number}"
+                mapped_classes.append(class_id)
+            classes.append(class_id)
+            objects[dotted.tables.students.student_number][class_id] = dotted
+
+    # df = pd.DataFrame.from_records([{'uniq_id': clss} for clss in set(mapped_classes)])
+    # df.to_csv(f'/tmp/output_mapped_classes.csv', index=False)
+    return (records, objects, set(classes))
+
+
+OUTPUT_FORMAT = "csv"
+EXTRACTS = "~/outputs/extracts"
+PARTIAL_MARKER = "PARTIAL"  # marks a partition holding a --changed-since pull
+JSON_NULLS = b"json_nulls"  # parquet metadata key, see write_extract()
+
+
+def extract_partition(run_date):
+    return os.path.join(os.path.expanduser(EXTRACTS), f"run_date={run_date}")
+
+
+def write_extract(df, name, csv_path, records=None):
+    """
+    Save an extract for debugging and audits: as csv at `csv_path`, or with the
+    parquet OUTPUT_FORMAT as zstd-compressed, typed parquet partitioned by run
+    date. Nested `records`, when given, are flattened into columns for parquet
+    """
+    if OUTPUT_FORMAT != "parquet":
+        df.to_csv(csv_path, index=False)
+        return
+    # parquet has only the one null, so note which cells were JSON nulls (None)
+    # rather than keys absent from the record (NaN) for replays to tell apart
+    json_nulls = defaultdict(list)
+    if records is not None:
+        df = pd.json_normalize(records)
+        for position, record in enumerate(records):
+            for path in null_paths(record):
+                json_nulls[path].append(position)
+    else:
+        for column in df.columns:
+            if df[column].dtype == object:
+                for position, value in enumerate(df[column].array):
+                    if value is None:
+                        json_nulls[column].append(position)
+    table = pyarrow.Table.from_pandas(df.convert_dtypes(), preserve_index=False)
+    table = table.replace_schema_metadata(
+        {**(table.schema.metadata or {}), JSON_NULLS: json.dumps(json_nulls)}
+    )
+    partition = extract_partition(datetime.date.today().isoformat())
+    os.makedirs(partition, exist_ok=True)
+    pyarrow.parquet.write_table(
+        table, os.path.join(partition, f"{name}.parquet"), compression="zstd"
+    )
+
+
+def null_paths(record: dict, prefix=""):
+    """
+    Dotted paths of the JSON nulls in a nested record
+    """
+    for key, value in record.items():
+        if value is None:
+            yield prefix + key
+        elif isinstance(value, dict):
+            yield from null_paths(value, f"{prefix}{key}.")
+
+
+def mark_partition(run_date, partial):
+    """
+    Flag the `run_date` partition as holding a filtered pull, or clear the flag
+    """
+    marker = os.path.join(extract_partition(run_date), PARTIAL_MARKER)
+    if partial:
+        os.makedirs(os.path.dirname(marker), exist_ok=True)
+        open(marker, "w").close()
+    elif os.path.exists(marker):
+        os.remove(marker)
+
+
+def read_extract(name, run_date):
+    """
+    Memory map the parquet extract saved on `run_date`, as the frame
+    pd.json_normalize gave: numpy columns, NaN for keys absent from a record
+    and None for JSON nulls
+    """
+    path = os.path.join(extract_partition(run_date), f"{name}.parquet")
+    table = pyarrow.parquet.read_table(path, memory_map=True)
+    json_nulls = json.loads((table.schema.metadata or {}).get(JSON_NULLS, b"{}"))
+    df = table.to_pandas(ignore_metadata=True)
+    df = df.where(df.notna(), np.nan)
+    for column, positions in json_nulls.items():
+        values = df[column].to_numpy(dtype=object, copy=True)
+        values[positions] = None
+        df[column] = values
+    return df
+
+
+def unflatten(df):
+    """
+    Nested records from a frame of dotted columns, leaving out the keys that
+    were absent (NaN) and keeping JSON nulls as None
+    """
+    records = []
+    for row in df.to_dict(orient="records"):
+        record = {}
+        for path, value in row.items():
+            if isinstance(value, float) and value != value:
+                continue
+            *parents, key = path.split(".")
+            node = record
+            for part in parents:
+                node = node.setdefault(part, {})
+            node[key] = value
+        records.append(record)
+    return records
+
+
+def replay_powerschool(run_date):
+    """
+    Load the extracts saved as parquet on `run_date` in place of pulling them
+    from PowerSchool, in the shape extract_powerschool returns
+    """
+    if os.path.exists(os.path.join(extract_partition(run_date), PARTIAL_MARKER)):
+        # replaying only what changed would read as everything else being gone
+        raise click.BadParameter(
+            f"the extracts from {run_date} are a --changed-since pull",
+            param_hint="--replay",
+        )
+    df = read_extract("enrollments", run_date)
+    records, objects, classes = index_enrollments([unflatten(df)])
+    results = {"enrollments": (df, objects, classes)}
+    for entity, path in ENTITY_KEYS.items():
+        results[entity] = index_entity(read_extract(entity, run_date), entity, path)
+    print(f"PowerSchool extracts replayed from {extract_partition(run_date)}")
+    return results
+
+
+class RelationshipIndex:
+    """
+    Each ManageBac parent's children as child id -> relationship, fetched at
+    most once per parent per run
+    """
+
+    def __init__(self, mb, workers=4):
+        self.mb = mb
+        self.workers = workers
+        self.children = {}
+
+    def fetch(self, parent_id):
+        return {
+            rel.get("id"): rel.get("relationship")
+            for rel in self.mb.generate_parentchild_relationships(parent_id)
+        }
+
+    def prefetch(self, parent_ids):
+        missing = [
+            parent_id
+            for parent_id in set(parent_ids)
+            if parent_id is not None and parent_id not in self.children
+        ]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for parent_id, children in zip(missing, pool.map(self.fetch, missing)):
+                self.children[parent_id] = children
+
+    def get(self, parent_id):
+        if parent_id not in self.children:
+            self.children[parent_id] = self.fetch(parent_id)
+        return self.children[parent_id]
+
+    def relate(self, parent_id, child_id, relationship):
+        """
+        Note a relationship whose write is queued, so it is not sent twice
+        """
+        self.children.setdefault(parent_id, {})[child_id] = relationship
+
+
+SNAPSHOT = "~/outputs/snapshot.sqlite"
+# PowerQuery argument the plugin's named queries accept to filter by
+# last-modified date, and the extracts to filter with it. Enrollments are
+# always pulled in full: one held back until its class begins is not modified
+# again, so a filtered pull would never return it
+CHANGED_SINCE_ARG = "whenmodified"
+CHANGED_SINCE_EXTRACTS = ["students", "parents"]
+
+
+def record_hash(value):
+    return hashlib.sha1(
+        json.dumps(value, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def frame_hashes(df, key):
+    """
+    Content hash of every row in `df`, keyed by its `key` column
+    """
+    hashes = pd.util.hash_pandas_object(df, index=False).astype(str)
+    return dict(zip(df[key], hashes))
+
+
+class Snapshot:
+    """
+    Per-record content hashes from the last successful run, per entity
+    """
+
+    def __init__(self, path=SNAPSHOT):
+        self.connection = sqlite3.connect(os.path.expanduser(path))
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS hashes "
+            "(entity TEXT, key TEXT, hash TEXT, PRIMARY KEY (entity, key))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS watermarks (name TEXT PRIMARY KEY, value TEXT)"
+        )
+
+    def changed(self, entity, hashes: dict):
+        """
+        Keys whose hash is new or differs from the last run
+        """
+        stored = dict(
+            self.connection.execute(
+                "SELECT key, hash FROM hashes WHERE entity = ?", (entity,)
+            )
+        )
+        return {key for key, value in hashes.items() if stored.get(str(key)) != value}
+
+    def store(self, snapshot_hashes: dict, partial=(), unsettled=()):
+        """
+        Replace the stored hashes; entities in `partial` only hold some of
+        their records this run, so theirs are updated instead. `unsettled`
+        keys did not sync, and are dropped so the next run sees them changed
+        """
+        unsettled = {str(key) for key in unsettled}
+        with self.connection:
+            for entity, hashes in snapshot_hashes.items():
+                if entity not in partial:
+                    self.connection.execute(
+                        "DELETE FROM hashes WHERE entity = ?", (entity,)
+                    )
+                self.connection.executemany(
+                    "DELETE FROM hashes WHERE entity = ? AND key = ?",
+                    [(entity, key) for key in unsettled],
+                )
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)",
+                    [
+                        (entity, str(key), value)
+                        for key, value in hashes.items()
+                        if str(key) not in unsettled
+                    ],
+                )
+
+    def watermark(self, name):
+        row = self.connection.execute(
+            "SELECT value FROM watermarks WHERE name = ?", (name,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, name, value):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO watermarks VALUES (?, ?)", (name, value)
+            )
+
+
+def membership_filters(date_string):
+    """
+    Arguments for the memberships the sync compares against
+    """
+    return dict(
+        class_happens_on=date_string, classes="active", users="active", per_page=200
+    )
+
+
+def collection_readers(mb, date_string):
+    """
+    How to read each paged ManageBac collection the sync compares against, as
+    name -> (endpoint returning a page with its meta, generator over the items
+    of one page, key of the items in a page)
+    """
+    students = dict(archived=None, modified_since=None)
+    memberships = membership_filters(date_string)
+    partial = functools.partial
+    return {
+        "students": (
+            partial(mb.endpoints.get_students, **students),
+            partial(mb.generate_students_by, **students),
+            "students",
+        ),
+        "teachers": (mb.endpoints.get_teachers, mb.generate_teachers_by, "teachers"),
+        "parents": (mb.endpoints.get_parents, mb.generate_parents_by, "parents"),
+        "classes": (
+            partial(mb.endpoints.get_classes, archived=0),
+            partial(mb.generate_classes_by, archived=False),
+            "classes",
+        ),
+        "archived_classes": (
+            partial(mb.endpoints.get_classes, archived=1),
+            partial(mb.generate_classes_by, archived=True),
+            "classes",
+        ),
+        "memberships": (
+            partial(mb.endpoints.get_memberships, **memberships),
+            partial(mb.generate_memberships_by, **memberships),
+            "memberships",
+        ),
+    }
+
+
+def read_collection(pages, get, generate, key):
+    """
+    Read page one of a collection for its page count, then every other page on
+    the pages pool; items repeated by a page shifting mid-read are dropped
+    """
+    first = get(page=1)
+    total_pages = (first.get("meta") or {}).get("total_pages") or 1
+    rest = pages.map(lambda page: list(generate(page=page)), range(2, total_pages + 1))
+    items, seen = [], set()
+    for item in itertools.chain(first.get(key, []), *rest):
+        id_ = item.get("id")
+        if id_ is None or id_ not in seen:
+            seen.add(id_)
+            items.append(item)
+    return items
+
+
+def prefetch_collections(mb, date_string, workers=4, names=None):
+    """
+    Read every ManageBac collection the sync compares against (or just those
+    in names) at the same time, their pages spread over a pool of workers,
+    returning a dict of name -> list of items
+    """
+    readers = collection_readers(mb, date_string)
+    if names is None:
+        names = ["year_groups", *readers]
+    # collections wait on their pages, so pages get a pool of their own
+    with ThreadPoolExecutor(max_workers=workers) as pages, ThreadPoolExecutor(
+        max_workers=len(names)
+    ) as pool:
+        futures = {
+            name: (
+                pool.submit(lambda: list(mb.generate_year_groups()))
+                if name == "year_groups"
+                else pool.submit(read_collection, pages, *readers[name])
+            )
+            for name in names
+        }
+        collections = {name: future.result() for name, future in futures.items()}
+    # generate_classes marks every class with the archived filter it came from
+    for name, archived in (("classes", False), ("archived_classes", True)):
+        for clss in collections.get(name, []):
+            clss["archived"] = archived
+    return collections
+
+
+def extract_powerschool(api, workers=1, filters=None):
+    """
+    Pull enrollments, students, teachers and parents at the same time over the
+    one PsWeb session, printing how long each extract took. `filters` maps an
+    extract to the PowerQuery arguments to send with it
+    """
+    filters = filters or {}
+    extracts = {
+        "enrollments": functools.partial(
+            load_enrollments, api, workers=workers, **filters.get("enrollments", {})
+        ),
+    }
+    for entity, path in ENTITY_KEYS.items():
+        extracts[entity] = functools.partial(
+            load_entity, api, entity, path, **filters.get(entity, {})
+        )
+
+    def timed(extract):
+        started = time.monotonic()
+        result = extract()
+        return result, time.monotonic() - started
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=len(extracts)) as pool:
+        futures = {
+            name: pool.submit(timed, extract) for name, extract in extracts.items()
+        }
+    results = {}
+    for name, future in futures.items():
+        results[name], elapsed = future.result()
+        print(f"PowerSchool {name} extracted in {elapsed:.1f}s")
+    print(f"PowerSchool extraction took {time.monotonic() - started:.1f}s")
+    return results
+
+
+def get_entity_by_key(mb: Endpoint, entity: str, key: str, query: str):
+    """ """
+    method = getattr(mb.endpoints, f"get_{entity}")
+    results = [
+        item for item in method(q=query).get(entity) if item.get(key) == query.strip()
+    ]
+    if len(results) == 0:
+        return None
+    assert len(results) == 1, "Issue with multiple students with same `student_id`"
+    return results.pop()
+
+
+RATE_LIMIT_RETRIES = 3
+
+
+def retry_after(response, attempt):
+    """
+    Seconds to wait before retrying `response`, or None if it was not a 429
+    """
+    if getattr(response, "status_code", None) != 429:
+        return None
+    value = response.headers.get("Retry-After")
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+        return max(0.0, when.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 2.0**attempt
+
+
+def retry_rate_limited(session, limited=None, retries=RATE_LIMIT_RETRIES):
+    """
+    Retry requests `session` is answered 429 for, waiting as long as
+    Retry-After asks, before the consumer sees the response; mbpy's own 429
+    backoff never gets that far. `limited()` is called on every 429
+    """
+
+    def hook(response, **kwargs):
+        for attempt in range(retries):
+            delay = retry_after(response, attempt)
+            if delay is None:
+                break
+            if limited is not None:
+                limited()
+            response.content
+            response.close()
+            time.sleep(delay)
+            request = response.request.copy()
+            retried = response.connection.send(request, **kwargs)
+            retried.history = [*response.history, response]
+            retried.request = request
+            response = retried
+        return response
+
+    session.hooks["response"].append(hook)
+    return session
+
+
+def call_endpoint(mb: Endpoint, description, *args, **kwargs):
+    """
+    Interact with the endpoint, returning the response and its record
+    """
+    response = None
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        try:
+            response = mb(*args, **kwargs)
+            record = {
+                "description": description,
+                "action": mb.__name__,
+                "args": ", ".join(args),
+                "kwargs": ", ".join(f"{k}={v}" for k, v in kwargs.items()),
+                "change": True,
+                "error": bool(response.get("error") or response.get('errors')),
+                "response": response,
+                "body": kwargs.get("body"),
+            }
+
+        except Exception as err:
+            delay = retry_after(getattr(err, "response", None), attempt)
+            if delay is not None and attempt < RATE_LIMIT_RETRIES:
+                time.sleep(delay)
+                continue
+            record = {
+                "description": description,
+                "action": mb.__name__,
+                "change": False,
+                "error": True,
+                "response": str(err),
+                "body": "Unexpected Error",
+            }
+        break
+
+    record.update(kwargs)
+    return response, record
+
+
+def execute(mb: Endpoint, records, description, *args, **kwargs):
+    """
+    Interact with the endpoint, add changed record
+    """
+    response, record = call_endpoint(mb, description, *args, **kwargs)
+    records.append(record)
+    return response
+
+
+def execute_many(mb: Endpoint, records, descriptions, *args, **kwargs):
+    """
+    Interact with the endpoint once, add a changed record per description
+    """
+    response, record = call_endpoint(mb, descriptions[0], *args, **kwargs)
+    records.extend(dict(record, description=d) for d in descriptions)
+    return response
+
+
+SYNC_LOG = "~/outputs/sync_output{timestamp}.csv"
+SYNC_LOG_COLUMNS = [
+    "description",
+    "action",
+    "args",
+    "kwargs",
+    "change",
+    "error",
+    "response",
+    "body",
+]
+RESPONSE_LIMIT = 500  # characters kept of responses that were not errors
+
+
+class SyncLog:
+    """
+    Sink for the sync's records: each row is written to a csv file as it
+    happens, and only running counts of changes and errors per action are
+    kept in memory for the summary. Used wherever a records list was.
+
+    Rows may belong to a record `key`, e.g. a student number; keys with an
+    error row, or that were held back, are `unsettled` and left out of the
+    snapshot so an incremental run looks at them again
+    """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, "w", newline="")
+        self.writer = csv.DictWriter(
+            self.file, fieldnames=SYNC_LOG_COLUMNS, extrasaction="ignore"
+        )
+        self.writer.writeheader()
+        self.lock = threading.Lock()
+        self.count = 0
+        self.changes = Counter()
+        self.errors = Counter()
+        self.unsettled = set()
+
+    def append(self, record: dict, key=None):
+        row = dict(record)
+        response = row.get("response")
+        if not isinstance(response, str):
+            response = json.dumps(response, default=str)
+        if not row.get("error"):
+            response = response[:RESPONSE_LIMIT]
+        row["response"] = response
+        with self.lock:
+            self.writer.writerow(row)
+            self.count += 1
+            if row.get("change"):
+                self.changes[row.get("action")] += 1
+            if row.get("error"):
+                self.errors[row.get("action")] += 1
+                if key is not None:
+                    self.unsettled.add(key)
+
+    def extend(self, records, key=None):
+        for record in records:
+            self.append(record, key=key)
+
+    def keyed(self, key):
+        """
+        View of the log whose rows belong to `key`
+        """
+        return KeyedLog(self, key)
+
+    def unsettle(self, key):
+        with self.lock:
+            self.unsettled.add(key)
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class KeyedLog:
+    """
+    SyncLog view for the rows of one record, see SyncLog.keyed()
+    """
+
+    def __init__(self, log: SyncLog, key):
+        self.log = log
+        self.key = key
+
+    def append(self, record: dict):
+        self.log.append(record, key=self.key)
+
+    def extend(self, records):
+        self.log.extend(records, key=self.key)
+
+
+def format_counts(counts: Counter):
+    """
+    Per-action counts, most frequent first, one per line
+    """
+    width = max(len(str(action)) for action in counts)
+    return "\n".join(
+        f"{str(action):<{width}}    {count}" for action, count in counts.most_common()
+    )
+
+
+class WriteExecutor:
+    """
+    Sends ManageBac writes through a bounded thread pool, throttled by a token
+    bucket of `rate` requests per second. The number of writes in flight
+    halves whenever one fails or ManageBac answers 429, and grows back by one
+    after as many successes as are currently allowed.
+    """
+
+    def __init__(self, workers=4, rate=10.0):
+        self.workers = workers
+        self.limit = workers
+        self.active = 0
+        self.successes = 0
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.pending = []
+        self.lock = threading.Lock()
+        self.slots = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.wait()
+        self.pool.shutdown()
+
+    def submit(self, then, mb: Endpoint, description, *args, **kwargs):
+        """
+        Queue a write; `then(response, record)` runs on the worker once it is done
+        """
+        future = self.pool.submit(self.run, then, mb, description, args, kwargs)
+        with self.lock:
+            self.pending.append(future)
+        return future
+
+    def run(self, then, mb, description, args, kwargs):
+        with self.slots:
+            self.slots.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+        failed = True
+        try:
+            self.throttle()
+            response, record = call_endpoint(mb, description, *args, **kwargs)
+            failed = record["error"]
+        finally:
+            with self.slots:
+                self.active -= 1
+                self.adapt(failed=failed)
+                self.slots.notify_all()
+        if then is not None:
+            then(response, record)
+        return response, record
+
+    def throttle(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+    def limited(self):
+        """
+        Back off as if a write failed; called for every 429, even one that is
+        retried successfully
+        """
+        with self.slots:
+            self.adapt(failed=True)
+
+    def adapt(self, failed):
+        if failed:
+            self.limit = max(1, self.limit // 2)
+            self.successes = 0
+        else:
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.workers:
+                self.limit += 1
+                self.successes = 0
+
+    def execute(self, mb: Endpoint, records, description, *args, **kwargs):
+        """
+        Like execute(), waiting for the write to finish and returning its response
+        """
+        response, record = self.submit(None, mb, description, *args, **kwargs).result()
+        records.append(record)
+        return response
+
+    def defer(self, mb: Endpoint, records, description, *args, **kwargs):
+        """
+        Like execute(), without waiting for the write to finish
+        """
+        self.submit(
+            lambda response, record: records.append(record),
+            mb,
+            description,
+            *args,
+            **kwargs,
+        )
+
+    def defer_many(self, mb: Endpoint, records, descriptions, *args, **kwargs):
+        """
+        Like execute_many(), without waiting for the write to finish
+        """
+        self.submit(
+            lambda response, record: records.extend(
+                dict(record, description=d) for d in descriptions
+            ),
+            mb,
+            descriptions[0],
+            *args,
+            **kwargs,
+        )
+
+    def wait(self):
+        """
+        Block until every queued write, including ones queued meanwhile, is done
+        """
+        while True:
+            with self.lock:
+                pending, self.pending = self.pending, []
+            if not pending:
+                return
+            for future in pending:
+                future.result()
+
+
+def term_start_dates(academic_years: dict):
+    """
+    Map (program code, term id) to the start of every academic term. Terms
+    without a parseable start are left out, so that only the classes using
+    them are affected
+    """
+    starts = {}
+    for program_code, program in academic_years.items():
+        if not program:
+            continue
+        for year in program.get("academic_years") or []:
+            for term in year.get("academic_terms") or []:
+                try:
+                    # use datetime as click's date param will need to be compared to it
+                    starts_on = datetime.datetime.fromisoformat(term.get("starts_on"))
+                except (TypeError, ValueError):
+                    continue
+                starts[(program_code, term.get("id"))] = starts_on
+    return starts
+
+
+def flush_year_groups(
+    writer, mb: Endpoint, records, pending: dict, memberships: dict, joining: bool
+):
+    """
+    Send buffered (description, student id, key) changes as one request per
+    year group, adding a record per student under its key. A failed request
+    is retried one student at a time, as in flush_class_adds(). `memberships`
+    (student id -> year group ids) is updated for every request that succeeds
+    """
+
+    def send(year_group_id, changes):
+        writer.submit(
+            functools.partial(done, year_group_id, changes),
+            mb,
+            changes[0][0],
+            id=year_group_id,
+            body={"student_ids": [student_id for _, student_id, _ in changes]},
+        )
+
+    def done(year_group_id, changes, response, record):
+        if record["error"] and len(changes) > 1:
+            for change in changes:
+                send(year_group_id, [change])
+            return
+        for description, _, key in changes:
+            records.append(dict(record, description=description), key=key)
+        if record["error"]:
+            return
+        for _, student_id, _ in changes:
+            if joining:
+                memberships[student_id].add(year_group_id)
+            else:
+                memberships[student_id].discard(year_group_id)
+
+    for year_group_id, changes in pending.items():
+        send(year_group_id, changes)
+    pending.clear()
+
+
+def flush_class_adds(writer, mb: Endpoint, records, pending: dict, batch_size):
+    """
+    Send buffered (description, student id, key) enrollments per class, at
+    most `batch_size` students per request. A failed request is retried one
+    student at a time, so each failure is recorded against its student
+    """
+
+    def done(class_id, chunk, response, record):
+        if record["error"] and len(chunk) > 1:
+            for description, student_id, key in chunk:
+                writer.defer(
+                    mb,
+                    records.keyed(key),
+                    description,
+                    class_id=class_id,
+                    body={"student_ids": [student_id]},
+                )
+        else:
+            for description, _, key in chunk:
+                records.append(dict(record, description=description), key=key)
+
+    for class_id, adds in pending.items():
+        for start in range(0, len(adds), batch_size):
+            chunk = adds[start : start + batch_size]
+            writer.submit(
+                functools.partial(done, class_id, chunk),
+                mb,
+                chunk[0][0],
+                class_id=class_id,
+                body={"student_ids": [student_id for _, student_id, _ in chunk]},
+            )
+    pending.clear()
+
+
+GUARDIAN_COLUMNS = {
+    "tables.emailaddress.guardian{num}_email": "email",
+    "tables.personaddress.guardian{num}_unit": "street_address",
+    "tables.personaddress.guardian{num}_street": "street_address_ii",
+    "tables.personaddress.guardian{num}_city": "city",
+    "tables.personaddress.guardian{num}_zipcode": "zipcode",
+    "tables.personphonenumberassoc.guardian{num}_phone": "mobile_phone_number",
+}
+PARENT_DEFAULTS = {"country": "US", "state": "Texas"}
+
+
+def diff_parent_profiles(psdf_parents, mb_parents: dict):
+    """
+    Stack both guardian slots of the PowerSchool parents into one long table,
+    join it against the ManageBac parents on lowercased email, and yield
+    (mb id, email, profile) for every guardian whose profile has changed
+    """
+    slots = []
+    for num in [1, 2]:
+        columns = {
+            column.format(num=num): name for column, name in GUARDIAN_COLUMNS.items()
+        }
+        slot = psdf_parents.reindex(columns=list(columns)).rename(columns=columns)
+        slot["slot"] = num
+        slots.append(slot)
+    guardians = pd.concat(slots, ignore_index=True)
+    # object dtype, as columns missing from the pull (or an empty filtered
+    # pull) come back from reindex as float
+    guardians = guardians[guardians["email"].notna()].assign(
+        email=lambda frame: frame["email"].astype(object).str.lower(),
+        **PARENT_DEFAULTS,
+    )
+    # the last PowerSchool row for an email wins, per guardian slot
+    guardians = guardians.drop_duplicates(subset=["email", "slot"], keep="last")
+
+    fields = [name for name in GUARDIAN_COLUMNS.values() if name != "email"]
+    fields += list(PARENT_DEFAULTS)
+    mb_frame = pd.DataFrame.from_records(
+        list(mb_parents.values()), columns=["id", *fields]
+    )
+    mb_frame["email"] = list(mb_parents.keys())
+    mb_frame["order"] = range(len(mb_frame))
+    merged = mb_frame.merge(guardians, on="email", suffixes=("_mb", ""))
+    merged = merged.sort_values(["order", "slot"], kind="stable")
+
+    ps_values = merged[fields]
+    mb_values = merged[[f"{name}_mb" for name in fields]].set_axis(fields, axis=1)
+    changed = (ps_values.notna() & (mb_values.isna() | ps_values.ne(mb_values))) | (
+        ps_values.isna() & mb_values.notna()
+    )
+    changed = merged[changed.any(axis=1)]
+    profiles = changed[fields].astype(object).where(changed[fields].notna(), None)
+    yield from zip(
+        changed["id"].tolist(),
+        changed["email"].tolist(),
+        profiles.to_dict(orient="records"),
+    )
+
+
+def parents_with_guardians(psdf_parents, emails):
+    """
+    Student numbers of the PowerSchool parents rows with a guardian whose
+    lowercased email is in `emails`
+    """
+    guardian_emails = psdf_parents.reindex(
+        columns=[f"tables.emailaddress.guardian{num}_email" for num in [1, 2]]
+    ).astype(object)
+    matches = guardian_emails.apply(lambda column: column.str.lower()).isin(emails)
+    return set(psdf_parents.loc[matches.any(axis=1), STUDENT_KEY])
+
+
+STUDENT_DATES = {"birthday": "tables.students.dateofbirth"}
+STUDENT_FIELDS = {
+    "email": "tables.students.email",
+    "last_name": "tables.students.last_name",
+    "first_name": "tables.students.first_name",
+    "middle_name": "tables.students.middle_name",
+    "other_name": "tables.students.house_name",
+    "gender": "tables.students.gender",
+}
+PS_DATE_FORMAT = "%d-%m-%Y"
+MB_DATE_FORMAT = "%Y-%m-%d"
+
+
+def diff_student_fields(psdf_students, key, mb_students: dict, homeroom_ids: dict):
+    """
+    Line up the PowerSchool students against the ManageBac students on
+    student_id, and yield (student_id, field, value) for every profile field
+    that ManageBac needs updated, in student then field order
+    """
+    ps = psdf_students.drop_duplicates(subset=[key], keep="last").set_index(key)
+    ps = ps.reindex(columns=[*STUDENT_DATES.values(), *STUDENT_FIELDS.values()])
+    ps = ps.set_axis([*STUDENT_DATES, *STUDENT_FIELDS], axis=1)
+    ps["gender"] = ps["gender"].map({"M": "Male", "F": "Female"})
+    ps["homeroom_advisor_id"] = pd.Series(
+        {k: v for k, v in homeroom_ids.items() if v}, dtype=object
+    )
+    mb = pd.DataFrame.from_records(
+        list(mb_students.values()), columns=["student_id", *ps.columns]
+    ).set_index("student_id")
+    ps, mb = ps.align(mb, join="inner", axis=0)
+
+    updates = pd.DataFrame(index=ps.index, dtype=object)
+    changed = pd.DataFrame(index=ps.index, dtype=bool)
+    for field in STUDENT_DATES:
+        ps_dates = pd.to_datetime(ps[field], format=PS_DATE_FORMAT)
+        mb_dates = pd.to_datetime(mb[field], format=MB_DATE_FORMAT)
+        set_value = ps_dates.notna() & (mb_dates.isna() | (ps_dates != mb_dates))
+        clear_value = ps_dates.isna() & mb[field].notna()
+        values = ps_dates.dt.strftime(MB_DATE_FORMAT).astype(object)
+        updates[field] = values.where(set_value, None)
+        changed[field] = set_value | clear_value
+    for field in [*STUDENT_FIELDS, "homeroom_advisor_id"]:
+        set_value = ps[field].notna() & (mb[field].isna() | ps[field].ne(mb[field]))
+        updates[field] = ps[field].astype(object).where(set_value, None)
+        changed[field] = set_value
+        if field in STUDENT_FIELDS:
+            # homerooms are left alone when they don't resolve to a teacher
+            cleared = ps[field].isna() & mb[field].notna() & mb[field].astype(bool)
+            changed[field] |= cleared
+
+    stacked = changed.stack()
+    for stu_id, field in stacked[stacked].index:
+        yield stu_id, field, updates.at[stu_id, field]
+
+
+def build_homeroom_index(psdf_teachers, records):
+    """
+    Map each teacher's full name to their lowercased email, flagging names
+    that more than one teacher shares
+    """
+    names = psdf_teachers["full_name"]
+    emails = psdf_teachers["tables.teachers.id"]
+    ambiguous = names.duplicated(keep=False)
+    index = dict(zip(names[~ambiguous], emails[~ambiguous]))
+    for full_name, matches in emails[ambiguous].groupby(names[ambiguous], sort=False):
+        records.append(
+            {
+                "description": full_name,
+                "action": "field_check",
+                "error": True,
+                "change": False,
+                "response": matches.to_string(),
+                "body": "",
+            }
+        )
+        index[full_name] = None
+    return index
+
+
+def full_name_to_mb_teacher(ps_stu, mb_teachers, homeroom_index, records):
+    homeroom_teacher_email = homeroom_index.get(ps_stu.tables.students.home_room)
+    if homeroom_teacher_email is None:
+        return None
+    mb_teacher = mb_teachers.get(homeroom_teacher_email, {"id": None})
+    if not mb_teacher:
+        print(f"No teacher with this email? {homeroom_teacher_email}")
+        records.append(
+            {
+                "description": f"{homeroom_teacher_email} not in MB",
+                "action": "field_check",
+                "error": True,
+                "change": False,
+                "response": None,
+                "body": "",
+            }
+        )
+    return mb_teacher.get("id")
+
+
+def run(
+    obj,
+    date,
+    postfix,
+    associations,
+    profiles,
+    provision_only,
+    ps_base_url,
+    ps_oauth_url,
+    client_id,
+    client_secret,
+    smtp_user,
+    smtp_password,
+    to_whom,
+    ps_workers,
+    ps_decoder,
+    batch_size,
+    pool_size,
+    mb_workers,
+    mb_rate,
+    http_cache,
+    incremental,
+    changed_since,
+    output_format,
+    replay,
+):
+    """
+    Syncronize PowerSchool to ManageBac
+    """
+    if len(to_whom) > 0 and not smtp_password:
+        raise Exception("Please provide password to send email")
+
+    date_string = date.strftime("%Y-%m-%d")
+
+    global DECODER
+    if ps_decoder == "ijson" and ijson is None:
+        raise click.BadParameter("ijson is not installed", param_hint="--ps-decoder")
+    if ps_decoder == "orjson" and orjson is None:
+        raise click.BadParameter("orjson is not installed", param_hint="--ps-decoder")
+    DECODER = ps_decoder or DECODER
+
+    global OUTPUT_FORMAT
+    if (output_format == "parquet" or replay) and pyarrow is None:
+        hint = "--replay" if replay else "--output-format"
+        raise click.BadParameter("pyarrow is not installed", param_hint=hint)
+    OUTPUT_FORMAT = output_format
+
+    mb = obj.Generator
+    # mbpy built the Endpoint before the cache was installed
+    configure_cache(http_cache, consumers=[mb.endpoints])
+    # mbpy built the Endpoint, so pool the connections of its session in place
+    mb_transport = pooled_session(
+        pool_size=pool_size, session=consumer_session(mb.endpoints)
+    )
+
+    snapshot = Snapshot()
+    run_started = datetime.date.today().isoformat()
+    filters = {}
+    if replay:
+        extracts = replay_powerschool(replay.strftime("%Y-%m-%d"))
+    else:
+        api = PsWeb(
+            client_id=client_id,
+            client_secret=client_secret,
+            base_url=ps_base_url,
+            ps_oauth_baseurl=ps_oauth_url,
+            pool_size=pool_size,
+        )
+
+        if changed_since and (watermark := snapshot.watermark("powerschool")):
+            print(f"Pulling PowerSchool records changed since {watermark}")
+            filters = {
+                extract: {CHANGED_SINCE_ARG: watermark}
+                for extract in CHANGED_SINCE_EXTRACTS
+            }
+
+        extracts = extract_powerschool(api, workers=ps_workers, filters=filters)
+        for host, (sent, opened) in transport_stats(api.transport).items():
+            print(f"{host}: {sent} requests over {opened} connections")
+        if OUTPUT_FORMAT == "parquet":
+            mark_partition(run_started, partial=bool(filters))
+    psdf_enrollments, ps_student_enrollments, _ = extracts["enrollments"]
+    mb_student_enrollments = defaultdict(list)
+    psdf_students, ps_students = extracts["students"]
+
+    psdf_teachers, teachers = extracts["teachers"]
+    # add lowercased emails
+    psdf_teachers = psdf_teachers.dropna(subset=["tables.teachers.id"])
+    psdf_teachers["tables.teachers.id"] = psdf_teachers["tables.teachers.id"].apply(
+        str.lower
+    )
+    middle_names = psdf_teachers["tables.teachers.middle_name"]
+    psdf_teachers["full_name"] = (
+        psdf_teachers["tables.teachers.last_name"]
+        + ", "
+        + psdf_teachers["tables.teachers.first_name"]
+        + (" " + middle_names).where(middle_names.astype(bool), "")
+    )
+
+    psdf_parents, parents = extracts["parents"]
+
+    to_be_removed = defaultdict(lambda: defaultdict(dict))
+    fields_to_be_updated = defaultdict(lambda: defaultdict(dict))
+
+    # rows stream to disk as they happen; only per-action counts stay in memory
+    records = SyncLog(SYNC_LOG.format(timestamp=f"_{date_string}{postfix}"))
+    missing_classes = []
+    homeroom_index = build_homeroom_index(psdf_teachers, records)
+    writer = WriteExecutor(workers=mb_workers, rate=mb_rate)
+    retry_rate_limited(mb_transport, limited=writer.limited)
+
+    try:
+        collections = prefetch_collections(mb, date_string, workers=mb_workers)
+
+        mb_year_groups = {}
+        for year_group in collections["year_groups"]:
+            if not year_group.get("id") in [10543690]:
+                mb_year_groups[year_group.get("grade_number")] = year_group
+
+        # student id -> ids of the year groups they are currently in
+        year_groups_by_id = {}
+        student_year_groups = defaultdict(set)
+        for year_group in mb_year_groups.values():
+            year_groups_by_id[year_group.get("id")] = year_group
+            for student_id in year_group.get("student_ids"):
+                student_year_groups[student_id].add(year_group.get("id"))
+
+        mb_students = {}
+        for student in collections["students"]:
+            student_id = student.get("student_id")
+            mb_students[student_id] = student
+
+        today: datetime.date = datetime.datetime.today().date()
+        date_query_param = today.strftime("%Y-%m-%d")
+
+        # look for students that need to be archived
+        for stu_id, mb_student in mb_students.items():
+            ps_student = ps_students.get(stu_id)
+            if ps_student is None:
+                if (
+                    not mb_student.get("archived")
+                    and not len(set(mb_student.get("student_id"))) == 1
+                ):
+                    pass
+                    # execute(
+                    #     mb.endpoints.archive_a_student,
+                    #     records,
+                    #     stu_id,
+                    #     id=mb_student.get("id"),
+                    #     withdrawn_on=date_query_param,
+                    # )
+
+        snapshot_hashes = {
+            "ps_students": frame_hashes(psdf_students, STUDENT_KEY),
+            "ps_teachers": frame_hashes(psdf_teachers, "tables.teachers.id"),
+            "ps_parents": frame_hashes(psdf_parents, STUDENT_KEY),
+            "mb_students": {
+                student.get("student_id"): record_hash(
+                    [student, sorted(student_year_groups[student.get("id")])]
+                )
+                for student in collections["students"]
+            },
+            "mb_teachers": {
+                teacher.get("email").lower(): record_hash(teacher)
+                for teacher in collections["teachers"]
+            },
+            "mb_parents": {
+                parent.get("email").lower(): record_hash(parent)
+                for parent in collections["parents"]
+            },
+        }
+        if incremental:
+            # only records that changed on either side since the last run go on
+            changed = {
+                entity: snapshot.changed(entity, hashes)
+                for entity, hashes in snapshot_hashes.items()
+            }
+            changed_students = changed["ps_students"] | changed["mb_students"]
+            ps_students = {
+                k: v for k, v in ps_students.items() if k in changed_students
+            }
+            changed_teachers = changed["ps_teachers"] | changed["mb_teachers"]
+            teachers = {k: v for k, v in teachers.items() if k in changed_teachers}
+            changed_parents = (
+                parents_with_guardians(psdf_parents, changed["mb_parents"])
+                | changed["ps_parents"]
+                | changed_students
+            )
+            parents = {k: v for k, v in parents.items() if k in changed_parents}
+            print(
+                f"Incremental sync of {len(ps_students)} students, "
+                f"{len(teachers)} teachers and {len(parents)} parents"
+            )
+
+        ## Have to process teachers here first
+
+        mb_teachers = {}
+        for teacher in collections["teachers"]:
+            email = teacher.get("email").lower()
+            mb_teachers[email] = teacher
+
+        mb_parents = {}
+        for parent in collections["parents"]:
+            email = parent.get("email").lower()
+            mb_parents[email] = parent
+
+        # parents whose PowerSchool address or phone differs from ManageBac
+        for mb_id, email, row in diff_parent_profiles(
+            psdf_parents[psdf_parents[STUDENT_KEY].isin(list(parents))], mb_parents
+        ):
+            writer.defer(
+                mb.endpoints.update_parent,
+                records.keyed(email),
+                email,
+                id=mb_id,
+                body={"parent": row},
+            )
+
+        # filter out None emails
+        for email, ps_teacher in [(e, t) for e, t in teachers.items() if e]:
+            mb_teach = mb_teachers.get(email)
+            if mb_teach is None:
+                body = {
+                    "teacher": {
+                        "email": ps_teacher.tables.teachers.id,
+                        "first_name": ps_teacher.tables.teachers.first_name,
+                        "last_name": ps_teacher.tables.teachers.last_name,
+                        "middle_name": ps_teacher.tables.teachers.middle_name,
+                    }
+                }
+                new_teacher = writer.execute(
+                    mb.endpoints.create_teacher, records.keyed(email), email, body=body
+                )
+                if not "id" in new_teacher:
+                    if error := new_teacher.get("errors"):
+                        print(error)
+                    print(f"Not adding teacher {email}")
+                    continue  # dev
+                mb_teachers[email] = new_teacher
+
+        if profiles:
+            homeroom_ids = {}
+            for stu_id, ps_student in ps_students.items():
+                if stu_id in mb_students:
+                    homeroom_ids[stu_id] = full_name_to_mb_teacher(
+                        ps_student, mb_teachers, homeroom_index, records
+                    )
+            for stu_id, property, value in diff_student_fields(
+                psdf_students[psdf_students[STUDENT_KEY].isin(list(ps_students))],
+                STUDENT_KEY,
+                mb_students,
+                homeroom_ids,
+            ):
+                fields_to_be_updated[stu_id][property] = value
+
+        # year-group changes are buffered per year group, and sent after the loop
+        year_group_adds = defaultdict(list)
+        year_group_removals = defaultdict(list)
+        unarchived_students = False
+
+        # Loop through students in PowerSchool
+        for stu_id, ps_student in ps_students.items():
+            mb_student = mb_students.get(stu_id)
+            student_grade = "".join(ps_student.tables.students.grade[1:])
+            if student_grade.isdigit():
+                class_grade_number = int(student_grade) + 1
+            else:
+                class_grade_number = {
+                    "KG": 1,
+                }.get(ps_student.tables.students.grade)
+            if not mb_student is None and mb_student.get("archived"):
+                writer.defer(
+                    mb.endpoints.unarchive_a_student,
+                    records.keyed(stu_id),
+                    stu_id,
+                    id=mb_student.get("id"),
+                )
+                unarchived_students = True
+            if mb_student is None:
+                day, month, year = ps_student.tables.students.dateofbirth.split("-")
+                body = {
+                    "student": {
+                        "student_id": stu_id,
+                        "birthday": f"{year}-{month}-{day}",
+                        "middle_name": ps_student.tables.students.middle_name,
+                        "last_name": ps_student.tables.students.last_name,
+                        "first_name": ps_student.tables.students.first_name,
+                        "email": ps_student.tables.students.email,
+                        # "nickname": ps_student.tables.u_student_additionals.nickname,
+                        "gender": {"F": "Female", "M": "Male"}.get(
+                            ps_student.tables.students.gender
+                        ),
+                        # "nationalities": ps_student.tables.u_country_codes.nat,
+                        "class_grade_number": class_grade_number,
+                    }
+                }
+                # Map home_room teacher to other_name
+                if ps_student.tables.students.house_name:
+                    body["student"][
+                        "other_name"
+                    ] = ps_student.tables.students.house_name
+
+                homeroom_advisor_id = full_name_to_mb_teacher(
+                    ps_student, mb_teachers, homeroom_index, records
+                )
+
+                # Map home_room to homeroom teacher
+                if homeroom_advisor_id:
+                    body["student"]["homeroom_advisor_id"] = homeroom_advisor_id
+
+                new_student = writer.execute(
+                    mb.endpoints.create_student,
+                    records.keyed(stu_id),
+                    stu_id,
+                    body=body,
+                )
+                if new_student is None:
+                    records.keyed(stu_id).append(
+                        {
+                            "description": "Error occurred when trying to create student",
+                            "action": "Create student",
+                            "error": True,
+                            "change": False,
+                            "response": None,
+                            "body": "",
+                        }
+                    )
+
+                else:
+                    record = new_student.get(
+                        "student", new_student
+                    )  # convoluted for dev
+
+                    if not "id" in record:
+                        print(f"Not adding student {stu_id}")
+                        continue  # dev
+                    mb_students[stu_id] = record
+
+                    # FIXME: add them to the right year group
+                    target_year_group = mb_year_groups.get(class_grade_number)
+                    assert target_year_group is not None, "Grade is wrong?"
+                    if (
+                        target_year_group.get("id")
+                        not in student_year_groups[record.get("id")]
+                    ):
+                        year_group_adds[target_year_group.get("id")].append(
+                            (
+                                f'{record.get("student_id")} > {ps_student.tables.students.grade}',
+                                record.get("id"),
+                                stu_id,
+                            )
+                        )
+
+            else:
+                uniq_student_id = mb_student.get("student_id")
+                if ps_stu := ps_students.get(uniq_student_id):
+                    # ensure enrolled into correct year_group
+                    target_year_group = mb_year_groups.get(class_grade_number)
+                    if target_year_group is None:
+                        raise Exception(f"No year group for {class_grade_number}")
+                    assert target_year_group is not None, "Grade is wrong?"
+                    if (
+                        target_year_group.get("id")
+                        not in student_year_groups[mb_student.get("id")]
+                    ):
+                        year_group_adds[target_year_group.get("id")].append(
+                            (
+                                f'{mb_student.get("student_id")} > {target_year_group.get("name")}',
+                                mb_student.get("id"),
+                                stu_id,
+                            )
+                        )
+
+                    if profiles:
+                        # ensure removed from other year_groups
+                        for year_group_id in sorted(
+                            student_year_groups[mb_student.get("id")]
+                            - {target_year_group.get("id")}
+                        ):
+                            year_group = year_groups_by_id[year_group_id]
+                            year_group_removals[year_group_id].append(
+                                (
+                                    f'{year_group.get("name")} < {mb_student.get("student_id")}',
+                                    mb_student.get("id"),
+                                    stu_id,
+                                )
+                            )
+
+                else:
+                    # TODO: Does not reach here
+                    writer.defer(
+                        mb.endpoints.archive_a_student,
+                        records.keyed(stu_id),
+                        mb_student.get("student_id"),
+                        id=mb_student.get("id"),
+                        withdrawn_on=date_query_param,
+                    )
+
+        # unarchives and creations must land before year groups change
+        writer.wait()
+        flush_year_groups(
+            writer,
+            mb.endpoints.add_to_year_group,
+            records,
+            year_group_adds,
+            student_year_groups,
+            joining=True,
+        )
+        flush_year_groups(
+            writer,
+            mb.endpoints.remove_from_year_group,
+            records,
+            year_group_removals,
+            student_year_groups,
+            joining=False,
+        )
+        writer.wait()
+
+        if unarchived_students:
+            # unarchiving students unarchives their parents, and brings back
+            # their memberships of active users, so both prefetched lists are stale
+            collections.update(
+                prefetch_collections(
+                    mb, date_string, mb_workers, names=["parents", "memberships"]
+                )
+            )
+        mb_parents = {}
+        for parent in collections["parents"]:
+            email = parent.get("email").lower()
+            mb_parents[email] = parent
+
+        relationships = RelationshipIndex(mb, workers=mb_workers)
+        if associations:
+            # every parent's children are fetched once, up front and concurrently
+            parent_ids = set()
+            for stu_id, ps_parent in parents.items():
+                if stu_id not in mb_students:
+                    continue
+                for par in ["guardian1", "guardian2"]:
+                    email = getattr(ps_parent.tables.emailaddress, f"{par}_email", None)
+                    if mb_parent := mb_parents.get(email):
+                        parent_ids.add(mb_parent.get("id"))
+            relationships.prefetch(parent_ids)
+
+        for stu_id, ps_parent in parents.items():
+            mb_stu = mb_students.get(
+                stu_id
+            )  # get_entity_by_key(mb, 'students', 'student_id', stu_id)
+            if mb_stu is None:
+                continue  # can occur in dev environment
+
+            # link parents to students
+            parent_list = []
+            for par in ["guardian1", "guardian2"]:
+                base = ps_parent
+                email = getattr(base.tables.emailaddress, f"{par}_email")
+                if hasattr(base.tables.codeset, f"{par}_relationship"):
+                    role = getattr(base.tables.codeset, f"{par}_relationship")
+                else:
+                    role = par
+                if email is None:
+                    records.append(
+                        {
+                            "description": "",
+                            "action": "missing_email",
+                            "error": False,
+                            "change": False,
+                            "response": f"{stu_id} has no parent email for {par}",
+                            "body": "",
+                        }
+                    )
+                    continue
+                handle = email.split("@")[0]
+                first_name = f"{par}_firstname"
+                first_name = (
+                    getattr(base.tables.person, first_name)
+                    if hasattr(base.tables.person, first_name)
+                    else handle
+                )
+                last_name = f"{par}_lastname"
+                last_name = (
+                    getattr(base.tables.person, last_name)
+                    if hasattr(base.tables.person, last_name)
+                    else handle
+                )
+                parent_list.append(
+                    (
+                        role,
+                        {
+                            "email": email,
+                            "first_name": first_name.title(),
+                            "last_name": last_name.title(),
+                            "gender": {"mother": "Female", "father": "Male"}.get(par),
+                        },
+                    )
+                )
+
+            for role, parent in parent_list:
+                email = parent.get("email")
+                mb_parent = mb_parents.get(
+                    email
+                )  # get_entity_by_key(mb, 'parents', 'email', email)
+                if mb_parent is None:
+                    new_parent = writer.execute(
+                        mb.endpoints.create_parent,
+                        records.keyed(stu_id),
+                        email,
+                        body={"parent": parent},
+                    )
+                    if not "id" in new_parent:
+                        continue  # dev, will not be able to associate
+                    mb_parent = new_parent
+
+                    # associate it here immediately, so we don't have to rely on running --associations
+                    writer.defer(
+                        mb.endpoints.add_child_association,
+                        records.keyed(stu_id),
+                        f"associate",
+                        parent_id=mb_parent.get("id"),
+                        body={"child": {"id": mb_stu.get("id"), "relationship": role}},
+                    )
+                    relationships.relate(mb_parent.get("id"), mb_stu.get("id"), role)
+                    mb_parents[email] = new_parent
+
+                if mb_parent.get("archived"):
+                    # shouldn't really get to this point, though, since we are unarchiving students, we'll get this for free
+                    # although if it happens just above, we won't have latest info
+                    # anyway, at least we'll have a record of it happening this way
+                    writer.defer(
+                        mb.endpoints.unarchive_a_parent,
+                        records.keyed(stu_id),
+                        email,
+                        id=mb_parent.get("id"),
+                    )
+
+                if associations:
+                    children = relationships.get(mb_parent.get("id"))
+                    if mb_stu.get("id") not in children:
+                        writer.defer(
+                            mb.endpoints.add_child_association,
+                            records.keyed(stu_id),
+                            f'{mb_stu.get("student_id")} -> {email}',
+                            parent_id=mb_parent.get("id"),
+                            body={
+                                "child": {"id": mb_stu.get("id"), "relationship": role}
+                            },
+                        )
+                        relationships.relate(
+                            mb_parent.get("id"), mb_stu.get("id"), role
+                        )
+                    elif children[mb_stu.get("id")] != role:
+                        writer.defer(
+                            mb.endpoints.update_child,
+                            records.keyed(stu_id),
+                            email,
+                            parent_id=mb_parent.get("id"),
+                            child_id=mb_stu.get("id"),
+                            body={"child": {"relationship": role}},
+                        )
+                        relationships.relate(
+                            mb_parent.get("id"), mb_stu.get("id"), role
+                        )
+
+        academic_years = mb.endpoints.get_academic_years()
+        term_starts = term_start_dates(academic_years)
+
+        # uses generate memberships endpoint
+        mb_classes = {}
+        for clss in collections["classes"]:
+            uniq_id = clss.get("uniq_id")
+            clss["archived"] = False
+            clss["start_date"] = term_starts.get(
+                (clss.get("program_code"), clss.get("start_term_id"))
+            )
+            mb_classes[uniq_id] = clss
+
+        for clss in collections["archived_classes"]:
+            uniq_id = clss.get("uniq_id")
+            assert uniq_id not in clss, "Class uniq IDs are not unique"
+            clss["archived"] = True
+            clss["start_date"] = term_starts.get(
+                (clss.get("program_code"), clss.get("start_term_id"))
+            )
+            mb_classes[uniq_id] = clss
+
+        for memb in collections["memberships"]:
+            membership = dot(memb)
+            try:
+                clss = mb_classes.get(
+                    membership.uniq_class_id
+                )  # get_entity_by_key(mb, 'classes', 'uniq_id', membership.class_id)
+            except AttributeError:
+                print(f'Missing uniq_class_id for class id={membership.id}')
+                continue
+
+            if membership.role == "Student":
+                uniq_student_id = membership.uniq_student_id.strip()
+                uniq_class_id = membership.uniq_class_id.strip()
+
+                # store mb enrollments for later comparison
+                mb_student_enrollments[uniq_student_id].append(uniq_class_id)
+
+                if uniq_student_id != membership.uniq_student_id:
+                    print(f'Whitespace "{uniq_student_id}"')
+                if uniq_class_id != membership.uniq_class_id:
+                    print(f'Whitespace "{uniq_class_id}"')
+                mb_student = mb_students.get(
+                    membership.uniq_student_id
+                )  # session.get(Student, membership.user_id)
+                clss = mb_classes.get(membership.uniq_class_id)
+
+                # if enrolled := ps_student_enrollments[uniq_student_id][uniq_class_id]:
+                #     pass  # print(enrolled)
+                # else:
+                #     to_be_removed[uniq_student_id][uniq_class_id] = SimpleNamespace(
+                #         student=mb_student, clss=clss
+                #     )
+
+        writer.wait()
+
+        # a student's enrollments are worth checking when either side changed,
+        # or when they have only just appeared in ManageBac
+        snapshot_hashes["ps_enrollments"] = {
+            stu_id: record_hash(sorted(classes))
+            for stu_id, classes in ps_student_enrollments.items()
+        }
+        snapshot_hashes["mb_enrollments"] = {
+            stu_id: record_hash(
+                [stu_id in mb_students, sorted(mb_student_enrollments.get(stu_id, []))]
+            )
+            for stu_id in ps_student_enrollments
+        }
+        enrolling = set(ps_student_enrollments)
+        if incremental:
+            enrolling = snapshot.changed(
+                "ps_enrollments", snapshot_hashes["ps_enrollments"]
+            ) | snapshot.changed("mb_enrollments", snapshot_hashes["mb_enrollments"])
+
+        if not provision_only:
+            for stu_id in to_be_removed:
+                for class_id in to_be_removed[stu_id]:
+                    item = to_be_removed[stu_id][class_id]
+                    mb_student = item.student
+                    mb_class = item.clss
+                    writer.defer(
+                        mb.endpoints.remove_students_from_class,
+                        records.keyed(stu_id),
+                        f"{class_id} < {stu_id}",
+                        class_id=mb_class.get("id"),
+                        body={"student_ids": [mb_student.get("id")]},
+                    )
+
+            for stu_id in fields_to_be_updated:
+                mb_student = mb_students.get(
+                    stu_id
+                )  # session.query(Student).where(Student.student_id==stu_id).one()
+
+                # all of a student's changed fields go in a single update
+                body = {"student": {}}
+                descriptions = []
+                for property, value in fields_to_be_updated[stu_id].items():
+                    if property == "nationalities":
+                        value = [value]
+                    body["student"][property] = value
+                    descriptions.append(f"{stu_id}.{property} = {value}")
+
+                writer.defer_many(
+                    mb.endpoints.update_a_student,
+                    records.keyed(stu_id),
+                    descriptions,
+                    id=mb_student.get("id"),
+                    body=body,
+                )
+
+            print("SS to be ADDED to CLASS")
+            # classes that student is supposed to be enrolled in according to PS, but not in MB yet
+            class_adds = defaultdict(list)
+
+            for stud_id in ps_student_enrollments:
+                if stud_id not in enrolling:
+                    continue
+                ps_stu = ps_students.get(stud_id)
+                ps_enrol = list(ps_student_enrollments[stud_id].keys())
+                mb_enrol = mb_student_enrollments[stud_id]
+                mb_student = mb_students.get(stud_id)
+
+                if mb_student is None:
+                    continue  # dev, new students won't be there yet
+
+                for add in set(ps_enrol) - set(mb_enrol):
+                    clss = mb_classes.get(add)
+                    if clss is None:
+                        # look at this student again once the class exists
+                        records.unsettle(stud_id)
+                        missing_classes.append(
+                            {"description": add, "error": True, "body": stu_id}
+                        )
+                    else:
+                        # FIXME: Check that the class has begun, it's possible to be in the source but not intended to be enrolled in MB yet
+                        # as it wouldn't be able to remove them, either
+                        if not academic_years.get(clss.get("program_code")):
+                            records.unsettle(stud_id)
+                            continue
+                        start_date = clss.get("start_date")
+                        assert start_date is not None, "start_date cannot be None"
+                        if start_date <= date:
+                            class_adds[clss.get("id")].append(
+                                (
+                                    f'{stud_id} > {clss.get("uniq_id")}',
+                                    mb_student.get("id"),
+                                    stud_id,
+                                )
+                            )
+                        else:
+                            # look at this student again next run, when the
+                            # class may have begun
+                            records.unsettle(stud_id)
+                            records.append(
+                                {
+                                    "description": f"{mb_student.get('student_id')} > {clss.get('uniq_id')}",
+                                    "error": False,
+                                    "change": False,
+                                    "body": "Not enrolling as class has not begun",
+                                    "action": "Enrol into class not yet started",
+                                }
+                            )
+
+            flush_class_adds(
+                writer,
+                mb.endpoints.add_student_to_class,
+                records,
+                class_adds,
+                batch_size,
+            )
+
+        writer.wait()
+        partial = []
+        if filters:
+            # a filtered pull only holds the records that changed
+            partial = ["ps_students", "ps_parents"]
+        snapshot.store(snapshot_hashes, partial=partial, unsettled=records.unsettled)
+        if not replay and not records.unsettled:
+            # a replay did not pull anything new from PowerSchool, and records
+            # whose writes failed or were held back must be pulled again until
+            # they sync; error rows that belong to no record, like teachers
+            # sharing a name, would otherwise hold the watermark forever
+            snapshot.set_watermark("powerschool", run_started)
+
+    finally:
+        writer.close()
+        records.close()
+        for host, (sent, opened) in transport_stats(mb_transport).items():
+            print(f"{host}: {sent} requests over {opened} connections")
+        if len(records) == 0:
+            print("no records?")
+        else:
+            print(f"{len(records)} records logged to {records.path}")
+            df2 = pd.DataFrame.from_records(missing_classes)
+
+            subject_description = ""
+            change_description = ""
+            error_description = ""
+            num_errors = sum(records.errors.values())
+            num_changes = sum(records.changes.values())
+            if num_errors > 0:
+                subject_description = f"{num_errors} errors"
+                error_description = format_counts(records.errors)
+
+            if num_changes > 0:
+                subject_description += f" {num_changes} changes"
+                change_description = format_counts(records.changes)
+
+            body = ""
+            if num_errors == 0 and num_changes == 0:
+                body += "Executed successfully. No changes needed, nor any errors encountered."
+            if num_errors > 0:
+                body += f"Executed, but some errors happened:\n{error_description}\n\n"
+            if num_changes > 0:
+                body += f"Summary of changes made:\n{change_description}"
+
+            if len(to_whom) > 0:
+                send_email(
+                    smtp_user,
+                    to_whom,
+                    f'Sync Output {"(" if subject_description else ""}{subject_description.strip()}{")" if subject_description else ""}',
+                    body,
+                    smtp_password,
+                    ("sync_output.csv", records.path),
+                    ("missing_classes.csv", df2),
+                    *[
+                        (f"powerschool_{name}.csv", d)
+                        for name, d in [
+                            ("students", psdf_students),
+                            ("parents", psdf_parents),
+                            ("enrollments", psdf_enrollments),
+                            ("teachers", psdf_teachers),
+                        ]
+                    ],
+                )
+            else:
+                print(body)
+
+    return records
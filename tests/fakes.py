@@ -0,0 +1,98 @@
+from types import SimpleNamespace
+
+
+class Response(SimpleNamespace):
+    """
+    Just enough of a requests response for the PowerSchool loaders: `body`
+    for the "json" DECODER, or the raw `chunks` of a streamed one
+    """
+
+    status_code = 200
+    request = SimpleNamespace(url="https://ps.example/ws/schema/query")
+    text = ""
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return self.body
+
+    def iter_content(self, chunk_size=1):
+        return iter(self.chunks)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PowerSchool:
+    """
+    PowerQueries over in-memory `records` per entity, paged like the real
+    ones. `failing` pages (entity, page) answer 500
+    """
+
+    def __init__(self, failing=(), **records):
+        self.records = records
+        self.failing = set(failing)
+
+    def __getattr__(self, name):
+        action, _, entity = name.partition("_")
+        if entity not in self.records:
+            raise AttributeError(name)
+        records = self.records[entity]
+        if action == "count":
+            return lambda **body: Response(body={"count": len(records)})
+
+        def get(pagesize=100, page=1, **body):
+            if (entity, page) in self.failing:
+                return Response(status_code=500, text="Internal Server Error")
+            start = (page - 1) * pagesize
+            return Response(body={"record": records[start : start + pagesize]})
+
+        return get
+
+
+class ManageBac:
+    """
+    The mbpy generator over in-memory `items` per collection, paged
+    `per_page` at a time like the real endpoints. `pages_read` records every
+    (collection, page) asked for
+    """
+
+    def __init__(self, per_page=2, **items):
+        self.items = items
+        self.per_page = per_page
+        self.pages_read = []
+        self.endpoints = SimpleNamespace(
+            **{f"get_{name}": self.getter(name) for name in items}
+        )
+        for name in items:
+            setattr(self, f"generate_{name}_by", self.generator(name))
+
+    def getter(self, name):
+        def get(page, **kwargs):
+            self.pages_read.append((name, page))
+            items = self.items[name]
+            start = (page - 1) * self.per_page
+            total_pages = max(1, -(-len(items) // self.per_page))
+            return {
+                name: [dict(item) for item in items[start : start + self.per_page]],
+                "meta": {"total_pages": total_pages},
+            }
+
+        return get
+
+    def generator(self, name):
+        def generate_by(page, **kwargs):
+            yield from getattr(self.endpoints, f"get_{name}")(page=page)[name]
+
+        return generate_by
+
+    def generate_year_groups(self):
+        yield from self.items.get("year_groups", [])
@@ -0,0 +1,27 @@
+import json
+
+import pytest
+
+from fakes import Response
+
+engine = pytest.importorskip("powerschool.engine")
+
+BODY = b'{"count":3,"record":[3.75,-1e-5,12,{"a":1.5E+3,"b":[0.25,true]}],"x":-0.5}'
+
+
+def stream(*chunks):
+    return list(engine.iter_json_stream(Response(chunks=chunks)))
+
+
+@pytest.mark.parametrize("cut", range(1, len(BODY)))
+def test_records_split_anywhere_decode_whole(cut):
+    assert stream(BODY[:cut], BODY[cut:]) == json.loads(BODY)["record"]
+
+
+def test_number_split_after_its_point():
+    assert stream(b'{"record":[3.', b"75]}") == [3.75]
+
+
+def test_byte_at_a_time():
+    chunks = [BODY[i : i + 1] for i in range(len(BODY))]
+    assert stream(*chunks) == json.loads(BODY)["record"]
@@ -0,0 +1,90 @@
+import datetime
+
+import pytest
+
+pytest.importorskip("pyarrow")
+pd = pytest.importorskip("pandas")
+engine = pytest.importorskip("powerschool.engine")
+
+STUDENTS = [
+    {
+        "tables": {
+            "students": {"student_number": "1", "middle_name": None, "grade": 9},
+            "emailaddress": {"guardian1_email": None},
+        }
+    },
+    {
+        "tables": {
+            "students": {"student_number": "2", "middle_name": "Lee", "grade": 10},
+            "emailaddress": {"guardian1_email": "a@x.org", "guardian2_email": "b@x"},
+        }
+    },
+]
+ENROLLMENTS = [
+    {
+        "tables": {
+            "students": {"student_number": "1"},
+            "sections": {"class_id": "MATH", "section_number": "1", "room": None},
+        }
+    },
+    {
+        "tables": {
+            "students": {"student_number": "2"},
+            "sections": {"class_id": "ART", "section_number": "A"},
+        }
+    },
+]
+PATHS = [
+    "tables.students.middle_name",
+    "tables.students.grade",
+    "tables.emailaddress.guardian1_email",
+    "tables.emailaddress.guardian2_email",
+    "tables.sections.room",
+    "tables.sections.class_id",
+]
+MISSING = object()
+
+
+def lookup(row, path):
+    for name in path.split("."):
+        row = getattr(row, name, MISSING)
+        if row is MISSING:
+            return MISSING
+    return row
+
+
+@pytest.fixture
+def parquet(tmp_path, monkeypatch):
+    monkeypatch.setattr(engine, "EXTRACTS", str(tmp_path))
+    monkeypatch.setattr(engine, "OUTPUT_FORMAT", "parquet")
+    return datetime.date.today().isoformat()
+
+
+def test_replayed_entity_reads_like_the_live_one(parquet):
+    df = pd.json_normalize(STUDENTS)
+    engine.write_extract(df.copy(), "students", None)
+    _, live = engine.index_entity(df, "students", engine.STUDENT_KEY)
+    _, replayed = engine.index_entity(
+        engine.read_extract("students", parquet), "students", engine.STUDENT_KEY
+    )
+
+    assert live.keys() == replayed.keys()
+    for key in live:
+        for path in PATHS:
+            expected = lookup(live[key], path)
+            assert lookup(replayed[key], path) == expected
+            assert type(lookup(replayed[key], path)) is type(expected)
+
+
+def test_replayed_enrollments_read_like_the_live_ones(parquet):
+    df = pd.DataFrame.from_records(ENROLLMENTS)
+    engine.write_extract(df, "enrollments", None, records=ENROLLMENTS)
+    _, live, live_classes = engine.index_enrollments([ENROLLMENTS])
+    records = engine.unflatten(engine.read_extract("enrollments", parquet))
+    _, replayed, replayed_classes = engine.index_enrollments([records])
+
+    assert replayed_classes == live_classes
+    for student, classes in live.items():
+        for class_id, row in classes.items():
+            for path in PATHS:
+                assert lookup(replayed[student][class_id], path) == lookup(row, path)
@@ -0,0 +1,47 @@
+import pytest
+
+from fakes import PowerSchool
+
+pytest.importorskip("pandas")
+engine = pytest.importorskip("powerschool.engine")
+
+WATERMARK = {engine.CHANGED_SINCE_ARG: "2024-08-20"}
+MB_PARENTS = {"a@x.org": {"id": 1, "email": "a@x.org", "city": "Austin"}}
+MB_STUDENTS = {"1": {"student_id": "1", "email": "s@x.org", "first_name": "Sam"}}
+
+
+class QuietNight(PowerSchool):
+    """
+    PowerSchool with nothing changed since the watermark
+    """
+
+    def __init__(self):
+        super().__init__(parents=[], students=[])
+
+
+@pytest.fixture
+def quiet_night(monkeypatch):
+    monkeypatch.setattr(engine, "DECODER", "json")
+    return QuietNight()
+
+
+def test_empty_filtered_pull_has_nothing_to_sync(quiet_night):
+    psdf_parents, parents = engine.load_entity(
+        quiet_night, "parents", engine.STUDENT_KEY, **WATERMARK
+    )
+    psdf_students, students = engine.load_entity(
+        quiet_night, "students", engine.STUDENT_KEY, **WATERMARK
+    )
+
+    assert parents == {} and students == {}
+    assert list(engine.diff_parent_profiles(psdf_parents, MB_PARENTS)) == []
+    assert engine.parents_with_guardians(psdf_parents, set(MB_PARENTS)) == set()
+    diff = engine.diff_student_fields(
+        psdf_students, engine.STUDENT_KEY, MB_STUDENTS, {}
+    )
+    assert list(diff) == []
+
+
+def test_unfiltered_pull_with_no_records_fails(quiet_night):
+    with pytest.raises(Exception, match="No parents records found"):
+        engine.load_entity(quiet_night, "parents", engine.STUDENT_KEY)
@@ -0,0 +1,63 @@
+import io
+
+import pytest
+
+requests = pytest.importorskip("requests")
+requests_cache = pytest.importorskip("requests_cache")
+urllib3 = pytest.importorskip("urllib3")
+uplink = pytest.importorskip("uplink")
+engine = pytest.importorskip("powerschool.engine")
+
+
+class Counting(requests.adapters.HTTPAdapter):
+    """
+    Answers every request 200 with an empty JSON body, counting them
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        self.sent.append(request.url)
+        raw = urllib3.HTTPResponse(
+            body=io.BytesIO(b"{}"),
+            headers={"Content-Type": "application/json"},
+            status=200,
+            preload_content=False,
+            request_url=request.url,
+        )
+        return self.build_response(request, raw)
+
+
+class ManageBac(uplink.Consumer):
+    @uplink.get("v2/classes")
+    def get_classes(self):
+        pass
+
+    @uplink.get("v2/year-groups")
+    def get_year_groups(self):
+        pass
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(engine, "HTTP_CACHE", str(tmp_path / "http_cache"))
+    yield
+    requests_cache.uninstall_cache()
+
+
+def test_consumer_built_before_the_cache_reads_through_it(cache):
+    mb = ManageBac(base_url="https://api.managebac.com/")
+    adapter = Counting()
+    engine.consumer_session(mb).mount("https://", adapter)
+    engine.configure_cache("on", consumers=[mb])
+
+    for _ in range(2):
+        mb.get_classes()
+        mb.get_year_groups()
+    assert sorted(adapter.sent) == [
+        "https://api.managebac.com/v2/classes",
+        "https://api.managebac.com/v2/year-groups",
+        "https://api.managebac.com/v2/year-groups",
+    ]
@@ -0,0 +1,39 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("mbpy.cli.contexts")
+
+# seconds powerschool.cli may add to an import of click and mbpy, which every
+# plugin pays anyway; listing plugins and --help should not feel the plugin
+IMPORT_BUDGET = 0.1
+HEAVY = ["pandas", "numpy", "uplink", "requests_cache", "pyarrow"]
+
+SCRIPT = """
+import json, sys, time
+import click, mbpy.cli.contexts
+before = set(sys.modules)
+started = time.perf_counter()
+import powerschool.cli
+elapsed = time.perf_counter() - started
+print(json.dumps({"elapsed": elapsed, "loaded": sorted(set(sys.modules) - before)}))
+"""
+
+
+def import_cli():
+    result = subprocess.run(
+        [sys.executable, "-c", SCRIPT], capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout)
+
+
+def test_cli_does_not_load_the_engine():
+    loaded = import_cli()["loaded"]
+    assert "powerschool.engine" not in loaded
+    assert not [name for name in loaded if name.split(".")[0] in HEAVY]
+
+
+def test_cli_imports_within_budget():
+    assert import_cli()["elapsed"] < IMPORT_BUDGET
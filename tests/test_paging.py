@@ -0,0 +1,54 @@
+import pytest
+
+from fakes import PowerSchool, Response
+
+pytest.importorskip("pandas")
+engine = pytest.importorskip("powerschool.engine")
+
+ENROLLMENTS = [
+    {
+        "tables": {
+            "students": {"student_number": str(number)},
+            "sections": {"class_id": f"C{number % 4}", "section_number": "1"},
+        }
+    }
+    for number in range(35)
+]
+
+
+@pytest.fixture(autouse=True)
+def decoder(monkeypatch):
+    monkeypatch.setattr(engine, "DECODER", "json")
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_every_enrollment_comes_back(workers):
+    api = PowerSchool(enrollments=ENROLLMENTS)
+    _, objects, classes = engine.load_enrollments(api, workers=workers)
+    assert len(objects) == 35
+    assert classes == {"C0", "C1", "C2", "C3"}
+
+
+def test_failed_enrollment_page_raises_when_fetched_concurrently():
+    api = PowerSchool(failing=[("enrollments", 2)], enrollments=ENROLLMENTS)
+    with pytest.raises(Exception, match="500"):
+        list(engine.fetch_enrollment_pages(api, 4, len(ENROLLMENTS), pagesize=10))
+
+
+def test_failed_enrollment_page_raises_when_fetched_in_turn():
+    api = PowerSchool(failing=[("enrollments", 1)], enrollments=ENROLLMENTS)
+    with pytest.raises(Exception, match="500"):
+        list(engine.iter_enrollment_pages(api))
+
+
+def test_fewer_enrollments_than_counted_raises():
+    api = PowerSchool(enrollments=ENROLLMENTS)
+    api.count_enrollments = lambda **body: Response(body={"count": 40})
+    with pytest.raises(Exception, match="35 of 40"):
+        engine.load_enrollments(api, workers=1)
+
+
+def test_failed_entity_page_raises():
+    api = PowerSchool(failing=[("students", 1)], students=[{"id": 1}])
+    with pytest.raises(Exception, match="500"):
+        list(engine.iter_entity_pages(api, "students"))
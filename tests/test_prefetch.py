@@ -0,0 +1,33 @@
+import pytest
+
+from fakes import ManageBac
+
+engine = pytest.importorskip("powerschool.engine")
+
+COLLECTIONS = dict(
+    students=[{"id": n} for n in range(5)],
+    teachers=[{"id": n} for n in range(3)],
+    parents=[],
+    classes=[{"id": n} for n in range(4)],
+    memberships=[{"id": n} for n in range(7)],
+    year_groups=[{"id": 1}],
+)
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_every_page_of_every_collection_comes_back(workers):
+    mb = ManageBac(**COLLECTIONS)
+    collections = engine.prefetch_collections(mb, "2024-08-20", workers=workers)
+
+    for name in ["students", "teachers", "parents", "memberships", "year_groups"]:
+        assert collections[name] == COLLECTIONS[name]
+    assert [clss["id"] for clss in collections["archived_classes"]] == [0, 1, 2, 3]
+    assert all(clss["archived"] for clss in collections["archived_classes"])
+    assert not any(clss["archived"] for clss in collections["classes"])
+    assert mb.pages_read.count(("memberships", 4)) == 1
+
+
+def test_items_repeated_across_pages_come_back_once():
+    mb = ManageBac(**dict(COLLECTIONS, students=[{"id": 1}, {"id": 2}, {"id": 2}]))
+    collections = engine.prefetch_collections(mb, "2024-08-20", names=["students"])
+    assert collections == {"students": [{"id": 1}, {"id": 2}]}
@@ -0,0 +1,76 @@
+import pytest
+
+requests = pytest.importorskip("requests")
+engine = pytest.importorskip("powerschool.engine")
+
+
+class Throttled(requests.adapters.BaseAdapter):
+    """
+    Answers the first `limited` requests 429 with a zero Retry-After, then 200
+    """
+
+    def __init__(self, limited):
+        super().__init__()
+        self.limited = limited
+        self.sent = 0
+
+    def send(self, request, **kwargs):
+        self.sent += 1
+        response = requests.Response()
+        response.request = request
+        response.connection = self
+        response.status_code = 429 if self.sent <= self.limited else 200
+        response.headers["Retry-After"] = "0"
+        response._content = b"{}"
+        return response
+
+    def close(self):
+        pass
+
+
+def throttled_session(answers_429, **kwargs):
+    session = requests.Session()
+    adapter = Throttled(answers_429)
+    session.mount("https://", adapter)
+    return engine.retry_rate_limited(session, **kwargs), adapter
+
+
+def test_429_is_retried_before_the_consumer_sees_it():
+    backoffs = []
+    session, adapter = throttled_session(2, limited=lambda: backoffs.append(1))
+    response = session.get("https://api.managebac.com/v2/students")
+    assert response.status_code == 200
+    assert adapter.sent == 3 and len(backoffs) == 2
+    assert [r.status_code for r in response.history] == [429, 429]
+
+
+def test_429_comes_back_once_retries_run_out():
+    session, adapter = throttled_session(10, retries=2)
+    assert session.get("https://api.managebac.com/v2/students").status_code == 429
+    assert adapter.sent == 3
+
+
+def test_error_responses_shrink_the_writes_in_flight():
+    def add_to_year_group(**kwargs):
+        return {"error": "Too many requests"}
+
+    writer = engine.WriteExecutor(workers=4, rate=1000)
+    _, record = writer.submit(None, add_to_year_group, "add").result()
+    writer.close()
+    assert record["error"] and writer.limit == 2
+
+
+def test_consumer_requests_are_retried():
+    uplink = pytest.importorskip("uplink")
+
+    class ManageBac(uplink.Consumer):
+        @uplink.get("v2/students")
+        def get_students(self):
+            pass
+
+    mb = ManageBac(base_url="https://api.managebac.com/")
+    adapter = Throttled(1)
+    engine.consumer_session(mb).mount("https://", adapter)
+    engine.retry_rate_limited(engine.consumer_session(mb))
+    assert mb.get_students().status_code == 200
+    assert adapter.sent == 2